@@ -1,12 +1,136 @@
 # Generate a raster plot of spiking
 
+from operator import itemgetter
+
+import numpy as np
 from netpyne import __gui__
 
 if __gui__:
     import matplotlib.patches as mpatches
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
 from ..analysis.utils import exception  # , loadData
 from ..analysis.tools import loadData
-from .plotter import ScatterPlotter
+from .plotter import ScatterPlotter, colorList as defaultColorList
+
+def _popCounts(sortedInds, edges):
+    """Return the number of spikes in each population
+
+    ``sortedInds`` are the spike indices sorted by cell; population ``i`` covers the cell indices ``[edges[i], edges[i + 1])``.
+    """
+    return np.diff(np.searchsorted(sortedInds, edges, side='left'))
+
+
+def _cellRanks(orderBy, sim=None):
+    """Return, indexed by gid, the y-axis position of every cell when cells are ordered by the ``orderBy`` tag
+
+    Cells with equal tags keep their gid order.
+    """
+    if sim is None:
+        from .. import sim
+
+    # Use the gathered cell list when available, since the local cells are not indexed by gid under MPI
+    if getattr(sim.net, 'allCells', None):
+        allCells = sim.net.allCells
+    else:
+        allCells = [{'gid': c.gid, 'tags': c.tags} for c in sim.net.cells]
+    allCells = sorted(allCells, key=lambda c: c['gid'])
+
+    # Extract the gid and tag of every cell once
+    gids = np.fromiter((c['gid'] for c in allCells), dtype=np.int64, count=len(allCells))
+    try:
+        tagArr = np.fromiter((c['tags'][orderBy] for c in allCells), dtype=np.float64, count=len(allCells))
+    except (TypeError, ValueError):
+        tagArr = np.array([c['tags'][orderBy] for c in allCells], dtype=object)
+
+    rank = np.zeros(gids.max() + 1 if len(gids) else 0, dtype=np.int32)
+    rank[gids[np.argsort(tagArr, kind='stable')]] = np.arange(len(gids), dtype=np.int32)
+    return rank
+
+
+def _spikePhases(spkTimes, colorbyPhase, sim=None):
+    """Return the phase (in degrees) of the band-passed ``colorbyPhase['signal']`` at each spike time, or NaN outside the signal
+
+    The signal is filtered with a zero-phase Butterworth band-pass in second-order sections and the phase is taken from its analytic signal.
+    """
+    from scipy.signal import butter, sosfiltfilt, hilbert
+
+    signal = colorbyPhase['signal']
+    if isinstance(signal, str) and signal == 'LFP':
+        if sim is None:
+            from .. import sim
+        electrode = colorbyPhase.get('electrode', 1)
+        signal = np.asarray(sim.allSimData['LFP'])[:, electrode - 1]
+        fs = 1000.0 / sim.cfg.recordStep
+    else:
+        if isinstance(signal, str):
+            signal = loadData(signal)
+        signal = np.asarray(signal, dtype=np.float64)
+        fs = colorbyPhase.get('fs', 1000)
+
+    # Keep the upper cutoff below Nyquist so the filter design stays valid
+    lo, hi = colorbyPhase.get('filtFreq', [1, 500])
+    hi = min(hi, 0.99 * fs / 2)
+    sos = butter(colorbyPhase.get('filtOrder', 3), [lo, hi], btype='band', fs=fs, output='sos')
+    filtered = sosfiltfilt(sos, signal)
+    phase = np.angle(hilbert(filtered), deg=True)
+
+    # Look up the phase sample at each spike time (ms) in one vectorized call;
+    # spikes outside the recorded signal have no phase
+    timeAxis = np.arange(len(signal)) * 1000.0 / fs
+    inds = np.minimum(np.searchsorted(timeAxis, spkTimes), len(timeAxis) - 1)
+    inSignal = (spkTimes >= timeAxis[0]) & (spkTimes <= timeAxis[-1])
+    return np.where(inSignal, phase[inds], np.nan)
+
+
+def _minMaxIndices(values, numOut):
+    """Return the indices of the smallest and largest value in each of ``numOut // 2`` equal-count bins"""
+    numBins = max(numOut // 2, 1)
+    binIds = (np.arange(len(values)) * numBins) // len(values)
+    order = np.lexsort((values, binIds))
+    binStarts = np.searchsorted(binIds[order], np.arange(numBins), side='left')
+    binStops = np.append(binStarts[1:], len(values))
+    return np.unique(np.concatenate((order[binStarts], order[binStops - 1])))
+
+
+def _downsampleRaster(sortedTimes, cells, starts, stops, method, numOut):
+    """Reduce each cell's spike train to at most ``numOut`` spikes
+
+    Spikes are selected on their inter-spike intervals, so that the bursts and pauses of each stretch
+    of the train are kept.  ``'lttb'`` and ``'minmax'`` use ``tsdownsample`` when it is installed;
+    otherwise both fall back to a NumPy MinMax selection.
+
+    Cell ``cells[k]`` owns the spike times ``sortedTimes[starts[k]:stops[k]]``.
+    """
+    if method == 'minmax':
+        # MinMax keeps a pair of spikes per bin, so it needs an even output size
+        numOut = max(numOut - numOut % 2, 2)
+
+    downsampler = None
+    try:
+        import tsdownsample
+        if method == 'minmax':
+            downsampler = tsdownsample.MinMaxDownsampler()
+        else:
+            downsampler = tsdownsample.LTTBDownsampler()
+    except ImportError:
+        pass
+
+    outTimes, outInds = [], []
+    for cell, start, stop in zip(cells, starts, stops):
+        times = sortedTimes[start:stop]
+        if len(times) > numOut:
+            times = np.sort(times)
+            isi = np.diff(times, prepend=times[0])
+            if downsampler is not None:
+                keep = downsampler.downsample(times, isi, n_out=numOut)
+            else:
+                keep = _minMaxIndices(isi, numOut)
+            times = times[keep]
+        outTimes.append(times)
+        outInds.append(np.full(len(times), cell, dtype=cells.dtype))
+
+    return np.concatenate(outTimes), np.concatenate(outInds)
 
 
 @exception
@@ -21,6 +145,7 @@ def plotRaster(
     popLabels=None,
     popColors=None,
     syncLines=False,
+    downsample=False,
     colorbyPhase = None,
     legend=True,
     colorList=None,
@@ -62,7 +187,7 @@ def plotRaster(
 
         If a *dict* it must have keys ``'spkTimes'`` and ``'spkInds'`` and may optionally include ``'popNumCells'`` and ``'popLabels'``.
 
-        If a *str* it must represent a file path to previously saved data.
+        If a *str* it must represent a file path to previously saved data.  A ``.npz`` file must hold ``'spkTimes'`` and ``'spkInds'`` arrays; a ``.npy`` file must hold a 2-row array of spike times and spike indices.
 
     axis : matplotlib axis
         The axis to plot into, allowing overlaying of plots.
@@ -84,7 +209,7 @@ def plotRaster(
 
         *Default:* ``'gid'`` orders cells by their index
 
-        *Options:* any NetPyNe cell tag, e.g. ``'pop'``, ``'x'``, ``'ynorm'`` .
+        *Options:* any NetPyNe cell tag, e.g. ``'pop'``, ``'x'``, ``'ynorm'`` .  Data from ``analysis.prepareRaster`` (a *dict* with ``'spkGids'``) is already ordered and is plotted as is; otherwise ``spkInds`` are taken to be gids and are placed by the rank of their tag.
 
     popRates : bool
         whether to include the spiking rates in the plot title and legend.
@@ -115,6 +240,13 @@ def plotRaster(
 
         *Default:* ``False``
 
+    downsample : bool, str, int
+        Downsample each cell's spike train before plotting when the number of spikes exceeds ``downsampleThreshold`` (default ``500000``).  Spikes are selected on their inter-spike intervals, keeping bursts and pauses.  Uses ``tsdownsample`` if installed, otherwise a NumPy MinMax fallback.
+
+        *Default:* ``False`` plots every spike
+
+        *Options:* ``'lttb'`` (or ``True``), ``'minmax'``, or an *int* of at least ``3`` giving the maximum number of spikes kept per cell (LTTB).  Otherwise spikes per cell are limited to the axis width in pixels.
+
     colorbyPhase : dict
         Dictionary specifying conditions to plot spikes colored by the phase of a simultaneous signal, filtered in a given range
 
@@ -128,13 +260,13 @@ def plotRaster(
 
             ``'electrode'`` selects the electrode from the LFP setup. Default is electrode 1,
 
-            ``'filtFreq'`` is a list specifying the range for filtering the signal (band-pass). For example, ``[4,8]`` to select theta rhythm. The default is a very broadband filtering (essentially, the raw signal) ``[1,500]``,
+            ``'filtFreq'`` is a list specifying the range for filtering the signal (band-pass). For example, ``[4,8]`` to select theta rhythm. The default is a very broadband filtering (essentially, the raw signal) ``[1,500]``. Spikes outside the time span of the signal are drawn in gray,
 
             ``'filtOrder'`` is the filter order (Butterworth) to process the signal,
 
-            ``'pop_background'`` is a boolean option to color each population alternately with a gray background, for better visualization. The default is False,
+            ``'pop_background'`` is a boolean option to color each population alternately with a gray background, for better visualization. It only applies when ``orderBy`` is ``'gid'``. The default is False,
 
-            ``'include_signal'`` is a boolean option to plot the filtered signal below the raster plot. The default is False.
+            ``'include_signal'`` is not supported by this function and is ignored.
 
     legend : bool
         Whether or not to add a legend to the plot.
@@ -200,6 +332,16 @@ def plotRaster(
     linewidth : int
         line width
 
+    rasterized : bool
+        Whether to rasterize the spike markers when saving to vector formats (PDF/SVG).
+
+        *Default:* ``True`` keeps file size proportional to the image resolution rather than the number of spikes
+
+    mergePixels : bool
+        Whether to keep only one spike per screen pixel when there are more than ``mergePixelsThreshold`` (default ``50000``) spikes.  This is lossy: pixels are sized at the figure's creation dpi, so saving at a higher dpi or zooming in shows gaps.
+
+        *Default:* ``True`` merges spikes on large rasters; use ``False`` to plot every spike
+
 
 
     Returns
@@ -210,6 +352,18 @@ def plotRaster(
 
     """
 
+    # Make sure the downsampling option is one we know about
+    if isinstance(downsample, bool) or downsample is None:
+        pass
+    elif isinstance(downsample, str):
+        if downsample not in ('lttb', 'minmax'):
+            raise Exception("In plotRaster, downsample must be False, True, 'lttb', 'minmax' or an int, not '" + downsample + "'")
+    elif isinstance(downsample, (int, np.integer)):
+        if downsample < 3:
+            raise Exception('In plotRaster, an int downsample must be at least 3 spikes per cell, not ' + str(downsample))
+    else:
+        raise Exception("In plotRaster, downsample must be False, True, 'lttb', 'minmax' or an int, not " + repr(downsample))
+
     # If there is no input data, get the data from the NetPyNE sim object
     if rasterData is None:
         if 'sim' not in kwargs:
@@ -219,10 +373,23 @@ def plotRaster(
 
         rasterData = sim.analysis.prepareRaster(include=['allCells'], timeRange=timeRange, maxSpikes=maxSpikes, orderBy=orderBy)
 
+    # If input is a file name, load data from the file
+    if isinstance(rasterData, str):
+        if rasterData.endswith('.npz'):
+            with np.load(rasterData) as npzData:
+                rasterData = {key: npzData[key] for key in npzData.files}
+        elif rasterData.endswith('.npy'):
+            rasterData = np.load(rasterData)
+        else:
+            rasterData = loadData(rasterData)
+
+    # prepareRaster output (marked by its 'spkGids') already holds positions in the
+    # orderBy-sorted cell list rather than gids
+    indsOrdered = isinstance(rasterData, dict) and 'spkGids' in rasterData
+
     # If the input is a dictionary, use the data inside it
     if isinstance(rasterData, dict):
-        spkTimes = rasterData['spkTimes']
-        spkInds = rasterData['spkInds']
+        spkTimes, spkInds = itemgetter('spkTimes', 'spkInds')(rasterData)
         if 'popNumCells' in rasterData:
             popNumCells = rasterData['popNumCells']
         if 'popLabels' in rasterData:
@@ -235,14 +402,37 @@ def plotRaster(
         if len(rasterData) > 3:
             popLabels = rasterData[3]
 
+    # Work on contiguous arrays from here on; spike times stay float64 so that close spikes late
+    # in long simulations remain distinct, while gids fit in int32
+    spkTimes = np.ascontiguousarray(spkTimes, dtype=np.float64)
+    spkInds = np.ascontiguousarray(spkInds, dtype=np.int32)
+
+    # Group spikes by cell once; cell k owns spkInds/spkTimes[starts[k]:stops[k]]
+    cellOrder = np.argsort(spkInds, kind='stable')
+    spkInds = spkInds[cellOrder]
+    spkTimes = spkTimes[cellOrder]
+    starts = np.flatnonzero(np.diff(spkInds, prepend=spkInds[:1] - 1))
+    stops = np.append(starts[1:], len(spkInds)) if len(starts) else starts
+    cells = spkInds[starts]
+    del cellOrder
+
     # Ensure popNumCells and popLabels are not None
     if popNumCells is None:
-        popNumCells = [len(set(spkInds))]  # assuming one population
+        popNumCells = [len(cells)]  # assuming one population
     if popLabels is None:
         popLabels = ['Population']
 
-    # Define the cell indices for plotting synchrony lines
-    cellInds = list(set(spkInds))
+    # Cumulative cell boundaries: population i spans indices [edges[i], edges[i + 1])
+    popNumCells = np.asarray(popNumCells, dtype=np.int32)
+    edges = np.concatenate(([0], np.cumsum(popNumCells)))
+
+    # Plot options, with the same defaults as plotRaster
+    title = kwargs.get('title', 'Raster Plot of Spiking')
+    xlabel = kwargs.get('xlabel', 'Time (ms)')
+    ylabel = kwargs.get('ylabel', 'Cells')
+    s = kwargs.get('s', 5)
+    marker = kwargs.get('marker', '|')
+    linewidth = kwargs.get('linewidth', 2)
 
     # Create the scatter plotter
     plotter = ScatterPlotter()
@@ -250,27 +440,82 @@ def plotRaster(
     axis = plotter.getAxis(axis)
     plotter.setAttributes(title=title, xlabel=xlabel, ylabel=ylabel)
 
-    # Ensure spkInds is ordered properly
-    if orderBy == 'gid':
-        spkInds = sorted(spkInds)
-    else:
-        # Order spkInds by some other cell tag
-        spkInds = [spkInd for spkInd in sorted(spkInds, key=lambda x: sim.net.cells[x].tags[orderBy])]
-
-    # Plot the raster
-    scatter = axis.scatter(spkTimes, spkInds, s=s, marker=marker, linewidth=linewidth)
-
-    # Add synchrony lines if needed
-    if syncLines:
-        for cellInd in cellInds:
-            spike_times = [spkTimes[i] for i, ind in enumerate(spkInds) if ind == cellInd]
-            for spike_time in spike_times:
-                axis.vlines(spike_time, ymin=0, ymax=len(cellInds), colors='gray', linestyles='dotted', linewidth=linewidth)
+    # Phase coloring replaces the population colors, so there is no legend
+    if colorbyPhase:
+        legend = False
+
+    # Skip the per-spike work when there are no spikes; the figure is still labeled, shown and saved below
+    counts = np.zeros(len(popLabels), dtype=np.int64)
+    if len(spkTimes) > 0:
+        # Count the spikes in each population
+        counts = _popCounts(spkInds, edges)
+
+        # Optionally downsample each cell's spike train
+        plotTimes, plotInds = spkTimes, spkInds
+        if downsample and len(spkTimes) > kwargs.get('downsampleThreshold', 500000):
+            if isinstance(downsample, (int, np.integer)) and not isinstance(downsample, bool):
+                method, numOut = 'lttb', int(downsample)
+            else:
+                method, numOut = 'lttb' if downsample is True else downsample, int(axis.get_window_extent().width)
+            plotTimes, plotInds = _downsampleRaster(spkTimes, cells, starts, stops, method, numOut)
+
+        # Place each gid on the y-axis by the rank of its tag; the tag arrays are freed inside the helper
+        if orderBy != 'gid' and not indsOrdered:
+            plotInds = _cellRanks(orderBy, kwargs.get('sim'))[plotInds]
+
+        # For large rasters, merge spikes that fall on the same pixel
+        if kwargs.get('mergePixels', True) and len(plotTimes) > kwargs.get('mergePixelsThreshold', 50000):
+            bbox = axis.get_window_extent()
+            W, H = int(bbox.width), int(bbox.height)
+            t0, t1 = plotTimes.min(), plotTimes.max()
+            Nrows = plotInds.max() + 1
+            tbin = np.round((plotTimes - t0) / max(t1 - t0, 1e-12) * W).astype(np.int32)
+            ybin = np.round(plotInds * (H / Nrows)).astype(np.int32)
+            key = tbin.astype(np.int64) * (H + 1) + ybin
+            _, keep = np.unique(key, return_index=True)
+            keep.sort()
+            plotTimes, plotInds = plotTimes[keep], plotInds[keep]
+
+        # Color spikes by the phase of a simultaneous signal instead of by population
+        phaseKwargs = {}
+        if colorbyPhase:
+            spkPhases = _spikePhases(plotTimes, colorbyPhase, kwargs.get('sim'))
+            # Spikes outside the signal have NaN phase; draw them in gray rather than dropping them
+            phaseKwargs = {'c': spkPhases, 'cmap': plt.get_cmap('hsv').with_extremes(bad='0.5'),
+                           'vmin': -180, 'vmax': 180, 'plotnonfinite': True}
+
+            # Shade every other population in gray; populations are only contiguous rows in gid order
+            if colorbyPhase.get('pop_background') and orderBy == 'gid':
+                for popIndex in range(0, len(popLabels), 2):
+                    axis.axhspan(edges[popIndex], edges[popIndex + 1], color='0.9', zorder=0)
+
+        # Plot the raster
+        axis.scatter(plotTimes, plotInds, s=s, marker=marker, linewidth=linewidth,
+                     rasterized=kwargs.get('rasterized', True), **phaseKwargs)
+
+        # Add synchrony lines if needed
+        if syncLines:
+            # One segment per distinct spike time, added as a single prebuilt collection
+            uniqueTimes = np.unique(spkTimes)
+            segs = np.empty((len(uniqueTimes), 2, 2))
+            segs[:, 0, 0] = uniqueTimes
+            segs[:, 1, 0] = uniqueTimes
+            segs[:, 0, 1] = 0
+            segs[:, 1, 1] = len(cells)
+            axis.add_collection(LineCollection(segs, colors='gray', linestyles='dotted', linewidths=linewidth))
 
     # Add legend
     if legend:
-        legendHandles = [mpatches.Patch(color=popColors[pop], label=f'{pop} ({len([x for x in spkInds if x in range(sum(popNumCells[:i]), sum(popNumCells[:i + 1]))])})')
-                         for i, pop in enumerate(popLabels)]
+        # Resolve the color of each pop once, filling in defaults from the colorList
+        if not colorList:
+            colorList = defaultColorList
+        popColorsTemp = {popLabel: colorList[ipop % len(colorList)] for ipop, popLabel in enumerate(popLabels)}
+        if popColors:
+            popColorsTemp.update(popColors)
+        colors = [popColorsTemp[popLabel] for popLabel in popLabels]
+
+        legendHandles = [mpatches.Patch(color=colors[i], label=f'{popLabels[i]} ({counts[i]})')
+                         for i in range(len(popLabels))]
         axis.legend(handles=legendHandles, **kwargs.get('legendKwargs', {}))
 
     # Apply rcParams if provided